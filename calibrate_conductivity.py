@@ -6,17 +6,41 @@ This script provides an interface to calibrate conductivity sensors using the Mo
 Based on the sensor manual, it supports reading current values and performing calibration procedures.
 
 Usage: python calibrate_conductivity.py
+       python calibrate_conductivity.py --port /dev/ttyUSB0 read-conductivity
+       python calibrate_conductivity.py --port COM3 batch steps.txt
 """
 
-import serial
-import serial.tools.list_ports
+import io
+import os
 import time
+import select
 import struct
+import functools
+import shlex
+import threading
 import argparse
 import sys
 from datetime import datetime
 
 
+def build_crc16_table():
+    """Build the 256-entry lookup table for Modbus CRC16 (reflected polynomial 0xA001)"""
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            if crc & 0x0001:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+        table.append(crc)
+    return tuple(table)
+
+
+class ModbusError(Exception):
+    """Raised when a Modbus response is missing, corrupt or reports an error"""
+
+
 class ConductivityCalibrator:
     """Class for calibrating conductivity sensors via Modbus RTU protocol"""
     
@@ -50,16 +74,38 @@ class ConductivityCalibrator:
         "data_format": 22
     }
     
-    def __init__(self, port=None, baudrate=9600, device_address=4):
+    # Request frame layout shared by functions 03 and 06: address, function, register, count/value
+    MODBUS_REQUEST = struct.Struct('>BBHH')
+    
+    # Registers 0-2: temperature (x0.1 °C) followed by the ABCD conductivity float
+    MEASUREMENT_BLOCK = struct.Struct('>Hf')
+    
+    # A single big-endian 16-bit register value
+    REGISTER_VALUE = struct.Struct('>H')
+    
+    # Precomputed Modbus CRC16 table, one lookup per byte instead of eight shift/xor steps
+    CRC16_TABLE = build_crc16_table()
+    
+    # Timeout for the one extra attempt given to a slave that answers slower than read_timeout
+    SLOW_RESPONSE_TIMEOUT = 1.0
+    
+    def __init__(self, port=None, baudrate=9600, device_address=4, read_timeout=0.1):
         """Initialize the calibrator with connection settings"""
         self.port = port
         self.baudrate = baudrate
         self.device_address = device_address
+        self.read_timeout = read_timeout
         self.ser = None
+        self.fd = None
+        self.last_frame_end = 0.0
+        # Serializes transactions between the menu and the background poller
+        self.bus_lock = threading.Lock()
         self.connected = False
     
     def list_available_ports(self):
         """List all available serial ports"""
+        # pyserial is imported on first use so the tool starts without paying for it
+        import serial.tools.list_ports
         ports = serial.tools.list_ports.comports()
         print("\nAvailable serial ports:")
         for i, port in enumerate(ports):
@@ -68,6 +114,7 @@ class ConductivityCalibrator:
     
     def connect(self):
         """Connect to the serial port"""
+        import serial
         try:
             self.ser = serial.Serial(
                 port=self.port,
@@ -75,9 +122,21 @@ class ConductivityCalibrator:
                 bytesize=serial.EIGHTBITS,
                 parity=serial.PARITY_NONE,
                 stopbits=serial.STOPBITS_ONE,
-                timeout=1,
+                timeout=self.read_timeout,
                 write_timeout=1
             )
+            # Time on the wire for one character: start bit, 8 data bits, parity/stop bits
+            self.onebyte_time = 11.0 / self.baudrate
+            # Modbus RTU t3.5 silent interval between frames, fixed at 1.75ms above 19200 baud
+            self.t35 = max(0.00175, 3.5 * self.onebyte_time)
+            # POSIX ports expose a descriptor we can select() on; on Windows fileno() is inherited
+            # from io.RawIOBase and raises, so fall back to plain ser.read()
+            try:
+                self.fd = self.ser.fileno()
+            except (AttributeError, io.UnsupportedOperation, OSError):
+                self.fd = None
+            # Clear any power-up noise once; after that the request/response cycle keeps the line clean
+            self.ser.reset_input_buffer()
             self.connected = True
             print(f"\nConnected to {self.port} at {self.baudrate} baud")
             return True
@@ -89,78 +148,146 @@ class ConductivityCalibrator:
         """Disconnect from the serial port"""
         if self.ser and self.ser.is_open:
             self.ser.close()
+            self.fd = None
             self.connected = False
             print(f"\nDisconnected from {self.port}")
     
-    def calculate_crc(self, data):
+    def set_timeout(self, read_timeout):
+        """Change the serial read timeout, applying it to the open port if connected"""
+        with self.bus_lock:
+            self.read_timeout = read_timeout
+            if self.ser and self.ser.is_open:
+                self.ser.timeout = read_timeout
+    
+    def read_exact(self, length, timeout):
+        """Read up to length bytes straight from the port descriptor, returning as soon as they arrive"""
+        deadline = time.perf_counter() + timeout
+        chunks = []
+        remaining = length
+        while remaining > 0:
+            wait = deadline - time.perf_counter()
+            if wait <= 0:
+                break
+            readable, _, _ = select.select([self.fd], [], [], wait)
+            if not readable:
+                break
+            chunk = os.read(self.fd, remaining)
+            if not chunk:
+                # Readable but empty means the adapter went away
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b"".join(chunks)
+    
+    def wait_for_bus_idle(self):
+        """Sleep only for whatever is left of the t3.5 silent interval since the last frame"""
+        remaining = self.t35 - (time.perf_counter() - self.last_frame_end)
+        if remaining > 0:
+            time.sleep(remaining)
+    
+    def read_response(self, length):
+        """Read a response frame, allowing one slower retry if the slave hasn't finished"""
+        if self.fd is None:
+            response = self.ser.read(length)
+            if len(response) < length:
+                # Most slaves answer well inside read_timeout; don't fail a slow one outright
+                self.ser.timeout = self.SLOW_RESPONSE_TIMEOUT
+                try:
+                    response += self.ser.read(length - len(response))
+                finally:
+                    self.ser.timeout = self.read_timeout
+            self.last_frame_end = time.perf_counter()
+            return response
+        
+        # Allow the slave's turnaround plus the time the frame itself takes on the wire
+        response = self.read_exact(length, self.read_timeout + length * self.onebyte_time)
+        if len(response) < length:
+            # Most slaves answer well inside read_timeout; don't fail a slow one outright
+            response += self.read_exact(length - len(response), self.SLOW_RESPONSE_TIMEOUT)
+        self.last_frame_end = time.perf_counter()
+        return response
+    
+    @classmethod
+    def calculate_crc(cls, data):
         """Calculate Modbus CRC16 for the given data"""
         crc = 0xFFFF
-        for pos in data:
-            crc ^= pos
-            for _ in range(8):
-                if (crc & 0x0001) != 0:
-                    crc >>= 1
-                    crc ^= 0xA001
-                else:
-                    crc >>= 1
+        table = cls.CRC16_TABLE
+        for byte in data:
+            crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
         return crc.to_bytes(2, byteorder='little')
     
+    @classmethod
+    @functools.lru_cache(maxsize=64)
+    def build_read_frame(cls, device_address, register_addr, count):
+        """Build a CRC'd Modbus read holding registers (03) request"""
+        # Device address, function code 03, register address, number of registers
+        command = cls.MODBUS_REQUEST.pack(device_address, 0x03, register_addr, count)
+        return command + cls.calculate_crc(command)
+    
+    @classmethod
+    @functools.lru_cache(maxsize=64)
+    def build_write_frame(cls, device_address, register_addr, value):
+        """Build a CRC'd Modbus write single register (06) request"""
+        # Device address, function code 06, register address, value
+        command = cls.MODBUS_REQUEST.pack(device_address, 0x06, register_addr, value)
+        return command + cls.calculate_crc(command)
+    
+    def transact_read(self, register_addr, count):
+        """Send a function 03 request and return the register data, raising ModbusError on a bad reply. Caller must hold bus_lock."""
+        # Frames are cached, so repeated reads of a register skip framing and CRC work
+        command = self.build_read_frame(self.device_address, register_addr, count)
+        
+        # Send command
+        self.wait_for_bus_idle()
+        self.ser.write(command)
+        
+        # Calculate expected response length: 
+        # 1 byte address + 1 byte function code + 1 byte data length + data (2 bytes per register) + 2 bytes CRC
+        expected_length = 5 + (2 * count)
+        
+        # Read response
+        response = self.read_response(expected_length)
+        
+        if len(response) != expected_length:
+            # Drop any late or partial bytes so they don't prefix the next response
+            self.ser.reset_input_buffer()
+            raise ModbusError(f"Expected {expected_length} bytes, got {len(response)}")
+        
+        # Check CRC
+        if self.calculate_crc(response[:-2]) != response[-2:]:
+            self.ser.reset_input_buffer()
+            raise ModbusError(f"CRC mismatch in response: {response.hex()}")
+        
+        # Check device address
+        if response[0] != self.device_address:
+            self.ser.reset_input_buffer()
+            raise ModbusError(f"Unexpected device address in response: {response[0]}")
+        
+        # Check function code
+        if response[1] != 0x03:
+            # Check if error response
+            if response[1] == 0x83:
+                raise ModbusError(f"Device returned error code: {response[2]}")
+            self.ser.reset_input_buffer()
+            raise ModbusError(f"Unexpected function code in response: {response[1]}")
+        
+        # Extract data
+        data_length = response[2]
+        return response[3:3+data_length]
+    
     def read_register(self, register_addr, count=1):
         """Read a register or registers using Modbus function code 03"""
         if not self.connected:
             print("Not connected to a device")
             return None
         
-        # Build Modbus RTU command (function code 03 = read holding registers)
-        command = bytes([
-            self.device_address,  # Device address
-            0x03,                 # Function code (03 = read holding registers)
-            register_addr >> 8,   # Register address high byte
-            register_addr & 0xFF, # Register address low byte
-            0x00,                 # Number of registers high byte
-            count                 # Number of registers low byte
-        ])
-        
-        # Add CRC
-        command += self.calculate_crc(command)
-        
         try:
-            # Send command
-            self.ser.reset_input_buffer()
-            self.ser.write(command)
-            
-            # Calculate expected response length: 
-            # 1 byte address + 1 byte function code + 1 byte data length + data (2 bytes per register) + 2 bytes CRC
-            expected_length = 5 + (2 * count)
-            
-            # Read response
-            response = self.ser.read(expected_length)
-            
-            if len(response) != expected_length:
-                print(f"Error: Expected {expected_length} bytes, got {len(response)}")
-                return None
-            
-            # Check device address
-            if response[0] != self.device_address:
-                print(f"Error: Unexpected device address in response: {response[0]}")
-                return None
-            
-            # Check function code
-            if response[1] != 0x03:
-                # Check if error response
-                if response[1] == 0x83:
-                    print(f"Error: Device returned error code: {response[2]}")
-                else:
-                    print(f"Error: Unexpected function code in response: {response[1]}")
-                return None
-            
-            # Extract data
-            data_length = response[2]
-            data = response[3:3+data_length]
+            with self.bus_lock:
+                data = self.transact_read(register_addr, count)
             
             # For single register, return as integer
             if count == 1:
-                return (data[0] << 8) + data[1]
+                return self.REGISTER_VALUE.unpack_from(data)[0]
             
             # For multiple registers, return raw data for further processing
             return data
@@ -175,38 +302,36 @@ class ConductivityCalibrator:
             print("Not connected to a device")
             return False
         
-        # Build Modbus RTU command (function code 06 = write single register)
-        command = bytes([
-            self.device_address,  # Device address
-            0x06,                 # Function code (06 = write single register)
-            register_addr >> 8,   # Register address high byte
-            register_addr & 0xFF, # Register address low byte
-            value >> 8,           # Value high byte
-            value & 0xFF          # Value low byte
-        ])
-        
-        # Add CRC
-        command += self.calculate_crc(command)
-        
         try:
-            # Send command
-            self.ser.reset_input_buffer()
-            self.ser.write(command)
-            
-            # Read response (echo of the command if successful)
-            response = self.ser.read(8)  # 8 bytes for write response
-            
-            if len(response) != 8:
-                print(f"Error: Expected 8 bytes in response, got {len(response)}")
-                return False
+            with self.bus_lock:
+                command = self.build_write_frame(self.device_address, register_addr, value)
+                
+                # Send command
+                self.wait_for_bus_idle()
+                self.ser.write(command)
+                
+                # Read response (echo of the command if successful)
+                response = self.read_response(8)  # 8 bytes for write response
+                
+                if len(response) != 8:
+                    print(f"Error: Expected 8 bytes in response, got {len(response)}")
+                    self.ser.reset_input_buffer()
+                    return False
+                
+                # Check CRC
+                if self.calculate_crc(response[:-2]) != response[-2:]:
+                    print(f"Error: CRC mismatch in response: {response.hex()}")
+                    self.ser.reset_input_buffer()
+                    return False
+                
+                # Check if response matches command (success)
+                if response[:6] == command[:6]:
+                    return True
+                else:
+                    print(f"Error: Unexpected response: {response.hex()}")
+                    self.ser.reset_input_buffer()
+                    return False
             
-            # Check if response matches command (success)
-            if response[:6] == command[:6]:
-                return True
-            else:
-                print(f"Error: Unexpected response: {response.hex()}")
-                return False
-        
         except Exception as e:
             print(f"Error writing to register: {e}")
             return False
@@ -221,16 +346,18 @@ class ConductivityCalibrator:
             return temperature
         return None
     
-    def read_conductivity(self):
-        """Read the current conductivity value"""
-        # According to the manual, conductivity may be stored in float format (ABCD)
-        # Reading 2 registers to get the full 32-bit float
-        value = self.read_register(self.REGISTERS["conductivity"], 2)
-        if value is not None and len(value) == 4:
-            # Convert 4 bytes to float (ABCD format / Big Endian)
-            conductivity = struct.unpack('>f', value)[0]
+    def read_measurements(self):
+        """Read temperature and conductivity together in a single Modbus request"""
+        # Temperature (register 0) is followed by the 2-register conductivity float,
+        # so one 3-register read replaces two round trips on the bus
+        value = self.read_register(self.REGISTERS["temperature"], 3)
+        if value is not None and len(value) == self.MEASUREMENT_BLOCK.size:
+            # Decode the whole block in one call rather than field by field
+            raw_temperature, conductivity = self.MEASUREMENT_BLOCK.unpack(value)
+            temperature = raw_temperature * 0.1
+            print(f"Current temperature: {temperature}°C")
             print(f"Current conductivity: {conductivity} µS/cm")
-            return conductivity
+            return temperature, conductivity
         return None
     
     def read_standard_solution(self):
@@ -273,8 +400,179 @@ class ConductivityCalibrator:
         return False
 
 
+class MeasurementPoller(threading.Thread):
+    """Background thread that keeps the latest readings on hand while the menu waits for input"""
+    
+    # Delay between polls, and how old a snapshot may be before the menu reads the device itself
+    POLL_INTERVAL = 0.2
+    MAX_SNAPSHOT_AGE = 2.0
+    # After a failed poll the delay doubles up to this, so a missing device doesn't hog the bus
+    MAX_POLL_BACKOFF = 5.0
+    
+    def __init__(self, calibrator):
+        super().__init__(name="MeasurementPoller", daemon=True)
+        self.calibrator = calibrator
+        self.stop_event = threading.Event()
+        self.snapshot_lock = threading.Lock()
+        self.snapshot = None
+        self.snapshot_time = 0.0
+    
+    def run(self):
+        calibrator = self.calibrator
+        poll_delay = self.POLL_INTERVAL
+        while not self.stop_event.wait(poll_delay):
+            try:
+                # Take the bus once per transaction so a menu action can get in between the two
+                with calibrator.bus_lock:
+                    block = calibrator.transact_read(calibrator.REGISTERS["temperature"], 3)
+                with calibrator.bus_lock:
+                    solution = calibrator.transact_read(calibrator.REGISTERS["standard_solution"], 1)
+                raw_temperature, conductivity = calibrator.MEASUREMENT_BLOCK.unpack(block)
+            except Exception:
+                # Leave the snapshot to age out; a direct read from the menu reports the error
+                poll_delay = min(poll_delay * 2, self.MAX_POLL_BACKOFF)
+                continue
+            
+            poll_delay = self.POLL_INTERVAL
+            
+            snapshot = {
+                "temperature": raw_temperature * 0.1,
+                "conductivity": conductivity,
+                "standard_solution": calibrator.REGISTER_VALUE.unpack_from(solution)[0]
+            }
+            with self.snapshot_lock:
+                self.snapshot = snapshot
+                self.snapshot_time = time.monotonic()
+    
+    def latest(self):
+        """Return the latest snapshot, or None if there isn't a recent one"""
+        with self.snapshot_lock:
+            if time.monotonic() - self.snapshot_time > self.MAX_SNAPSHOT_AGE:
+                return None
+            return self.snapshot
+    
+    def invalidate(self):
+        """Discard the snapshot after a write so stale values aren't shown"""
+        with self.snapshot_lock:
+            self.snapshot = None
+            self.snapshot_time = 0.0
+    
+    def stop(self):
+        """Stop polling and wait for any in-flight transaction to finish"""
+        self.stop_event.set()
+        self.join()
+
+
+def build_parser():
+    """Build the command line parser for one-shot and batch use"""
+    parser = argparse.ArgumentParser(description="Read and calibrate conductivity sensors over Modbus RTU")
+    parser.add_argument("--port", help="Serial port, e.g. /dev/ttyUSB0 or COM3")
+    parser.add_argument("--baudrate", type=int, default=9600, help="Baud rate (default: 9600)")
+    parser.add_argument("--address", type=int, default=4, help="Device address (default: 4)")
+    parser.add_argument("--timeout", type=float, default=0.1, help="Read timeout in seconds (default: 0.1)")
+    
+    sub = parser.add_subparsers(dest="command", metavar="command")
+    add_device_commands(sub)
+    batch = sub.add_parser("batch", help="Run the commands in FILE, one per line, over a single connection")
+    batch.add_argument("file")
+    return parser
+
+
+def build_batch_parser():
+    """Build the parser for batch file lines, which take a device command but no connection options"""
+    parser = argparse.ArgumentParser(prog="batch line", add_help=False)
+    sub = parser.add_subparsers(dest="command", metavar="command", required=True)
+    add_device_commands(sub)
+    return parser
+
+
+def add_device_commands(sub):
+    """Add the commands that talk to the device, shared by the command line and batch files"""
+    sub.add_parser("read-temp", help="Read the current temperature")
+    sub.add_parser("read-conductivity", help="Read the current conductivity and temperature")
+    sub.add_parser("read-std", help="Read the standard solution setting")
+    set_std = sub.add_parser("set-std", help="Set the standard solution type")
+    set_std.add_argument("solution_type", type=int, choices=sorted(ConductivityCalibrator.STANDARD_SOLUTIONS))
+    sub.add_parser("calibrate", help="Send the calibration command")
+    reset = sub.add_parser("reset", help="Reset the device to factory defaults")
+    reset.add_argument("--yes", action="store_true", help="Confirm the factory reset")
+
+
+def run_command(calibrator, args):
+    """Run a single parsed command, returning True on success"""
+    if args.command == "read-temp":
+        return calibrator.read_temperature() is not None
+    if args.command == "read-conductivity":
+        return calibrator.read_measurements() is not None
+    if args.command == "read-std":
+        return calibrator.read_standard_solution() is not None
+    if args.command == "set-std":
+        return calibrator.set_standard_solution(args.solution_type)
+    if args.command == "calibrate":
+        return calibrator.perform_calibration()
+    if args.command == "reset":
+        if not args.yes:
+            print("Refusing to reset without --yes")
+            return False
+        return calibrator.reset_device()
+    print(f"Unknown command: {args.command}")
+    return False
+
+
+def run_batch(calibrator, batch_file):
+    """Run each command in batch_file in order, stopping at the first failure"""
+    # Lines only name a device command; the connection is already open, so options
+    # like --port would be silently ignored and are rejected instead
+    parser = build_batch_parser()
+    with open(batch_file, "r") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                args = parser.parse_args(shlex.split(line))
+            except (SystemExit, ValueError):
+                # argparse has already printed why; shlex raises ValueError on unbalanced quotes
+                print(f"{batch_file}:{line_number}: invalid command, stopping: {line}")
+                return False
+            print(f"> {line}")
+            if not run_command(calibrator, args):
+                print(f"{batch_file}:{line_number}: command failed, stopping")
+                return False
+    return True
+
+
+def run_cli(args, parser):
+    """Connect, run the requested command (or batch) and disconnect, returning an exit code"""
+    if not args.port:
+        parser.error("--port is required when a command is given")
+    
+    calibrator = ConductivityCalibrator(
+        port=args.port,
+        baudrate=args.baudrate,
+        device_address=args.address,
+        read_timeout=args.timeout
+    )
+    if not calibrator.connect():
+        return 1
+    
+    try:
+        if args.command == "batch":
+            success = run_batch(calibrator, args.file)
+        else:
+            success = run_command(calibrator, args)
+    finally:
+        calibrator.disconnect()
+    return 0 if success else 1
+
+
 def main():
     """Main function to run the calibration tool"""
+    parser = build_parser()
+    args = parser.parse_args()
+    if args.command is not None:
+        sys.exit(run_cli(args, parser))
+    
     print("=" * 60)
     print("Conductivity Sensor Calibration Tool")
     print("=" * 60)
@@ -316,13 +614,17 @@ def main():
     if not calibrator.connect():
         return
     
+    # Poll in the background so menu reads are answered without waiting on the bus
+    poller = MeasurementPoller(calibrator)
+    poller.start()
+    
     try:
         while True:
             print("\n" + "=" * 60)
             print("MAIN MENU")
             print("=" * 60)
             print("1. Read current temperature")
-            print("2. Read current conductivity")
+            print("2. Read current conductivity and temperature")
             print("3. Read standard solution setting")
             print("4. Set standard solution")
             print("5. Perform calibration")
@@ -332,14 +634,27 @@ def main():
             
             choice = input("\nEnter your choice [1-8]: ")
             
+            snapshot = poller.latest()
+            
             if choice == '1':
-                calibrator.read_temperature()
+                if snapshot:
+                    print(f"Current temperature: {snapshot['temperature']}°C")
+                else:
+                    calibrator.read_temperature()
             
             elif choice == '2':
-                calibrator.read_conductivity()
+                if snapshot:
+                    print(f"Current temperature: {snapshot['temperature']}°C")
+                    print(f"Current conductivity: {snapshot['conductivity']} µS/cm")
+                else:
+                    calibrator.read_measurements()
             
             elif choice == '3':
-                calibrator.read_standard_solution()
+                if snapshot:
+                    value = snapshot["standard_solution"]
+                    print(f"Current standard solution setting: {value} ({calibrator.STANDARD_SOLUTIONS.get(value, 'unknown')})")
+                else:
+                    calibrator.read_standard_solution()
             
             elif choice == '4':
                 print("\nStandard Solution Types:")
@@ -407,6 +722,11 @@ def main():
                                 print("Failed to change baud rate")
                         else:
                             print("Invalid baud rate option")
+                    
+                    new_timeout = input("Enter read timeout in seconds [current: {}] (leave empty to skip): ".format(calibrator.read_timeout))
+                    if new_timeout:
+                        calibrator.set_timeout(float(new_timeout))
+                        print(f"Read timeout changed to {calibrator.read_timeout} seconds")
                 
                 except ValueError:
                     print("Invalid input. Please enter valid numbers.")
@@ -417,11 +737,16 @@ def main():
             
             else:
                 print("\nInvalid choice. Please try again.")
+            
+            if choice in ('4', '5', '6', '7'):
+                # Settings may have changed; don't show readings taken before the write
+                poller.invalidate()
     
     except KeyboardInterrupt:
         print("\n\nOperation cancelled by user")
     
     finally:
+        poller.stop()
         calibrator.disconnect()
 
 
@@ -1,7 +1,9 @@
 import logging
-import json
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
+import atexit
+import queue
+import orjson
 from pathlib import Path
-from datetime import datetime, timedelta
 from threading import Lock
 import os
 
@@ -15,6 +17,10 @@ BUFFER_A = None
 BUFFER_B = None
 ACTIVE_BUFFER_FILE = None
 GUID_TRACKING_FILE = None
+active_buffer_cache = None
+active_buffer_lock = Lock()
+# One queue handler per log file, shared by every logger that writes to it
+queue_handlers = {}
 
 # Logging configuration
 LOGGING_MODES = {
@@ -35,12 +41,23 @@ LOGGING_MODES = {
     }
 }
 
+class LocalQueueHandler(QueueHandler):
+    """Queue log records untouched so the listener thread does all the formatting"""
+    def prepare(self, record):
+        # The stock prepare() formats the message and traceback in the logging thread so the
+        # record can be pickled; this queue never leaves the process, so skip that
+        return record
+
 def initialize():
     global config, LOG_FILE_PATH, TELEMETRY_FILE_PATH, ARCHIVE_FILE_PATH, BUFFER_A, BUFFER_B, ACTIVE_BUFFER_FILE, GUID_TRACKING_FILE
     
+    # Already initialized - don't reload the config or repeat the mkdirs
+    if config is not None:
+        return
+    
     # Load configuration
-    with open("config.json", "r") as config_file:
-        config = json.load(config_file)
+    with open("config.json", "rb") as config_file:
+        config = orjson.loads(config_file.read())
     
     # Initialize file paths
     LOG_FILE_PATH = Path(config["logFilePath"])
@@ -58,35 +75,32 @@ def initialize():
     
     # Initialize the GUID tracking file if it doesn't exist
     if not GUID_TRACKING_FILE.exists():
-        with open(GUID_TRACKING_FILE, 'w') as f:
-            json.dump({"payload_guids": [], "reading_guids": []}, f)
+        with open(GUID_TRACKING_FILE, 'wb') as f:
+            f.write(orjson.dumps({"payload_guids": []}))
 
 def get_tracked_guids():
-    """Read the GUID tracking file and return the contents"""
+    """Read the payload GUID tracking file, falling back to an empty list"""
+    guid_data = {"payload_guids": []}
     try:
-        if not GUID_TRACKING_FILE.exists():
-            with open(GUID_TRACKING_FILE, 'w') as f:
-                json.dump({"payload_guids": [], "reading_guids": []}, f)
-            return {"payload_guids": [], "reading_guids": []}
-            
-        with open(GUID_TRACKING_FILE, 'r') as f:
-            return json.load(f)
+        if GUID_TRACKING_FILE.exists():
+            with open(GUID_TRACKING_FILE, 'rb') as f:
+                guid_data.update(orjson.loads(f.read()))
+        return guid_data
     except Exception as e:
         logging.error(f"Error reading GUID tracking file: {e}")
-        return {"payload_guids": [], "reading_guids": []}
+        return {"payload_guids": []}
 
 def save_tracked_guids(guid_data):
     """Save the GUID tracking data to disk"""
     try:
         # Ensure we don't let this file grow too large 
-        # Keep at most the last 1000 GUIDs of each type
-        if len(guid_data["payload_guids"]) > 1000:
-            guid_data["payload_guids"] = guid_data["payload_guids"][-1000:]
-        if len(guid_data["reading_guids"]) > 10000:
-            guid_data["reading_guids"] = guid_data["reading_guids"][-10000:]
-            
-        with open(GUID_TRACKING_FILE, 'w') as f:
-            json.dump(guid_data, f)
+        # Keep at most the last 1000 payload GUIDs
+        stored = {"payload_guids": list(guid_data["payload_guids"])[-1000:]}
+        
+        tmp_file = GUID_TRACKING_FILE.with_suffix('.tmp')
+        with open(tmp_file, 'wb') as f:
+            f.write(orjson.dumps(stored))
+        os.replace(tmp_file, GUID_TRACKING_FILE)
     except Exception as e:
         logging.error(f"Error saving GUID tracking data: {e}")
 
@@ -107,56 +121,103 @@ def setup_logging(module_name, log_file_path=None):
     log_config = LOGGING_MODES[logging_mode]
     logger = logging.getLogger(module_name)
     
-    # Ensure log directory exists
+    # Already configured by an earlier call; don't open the log file again
+    if logger.handlers:
+        return logger
+    
     if log_file_path is None:
         log_file_path = LOG_FILE_PATH
-    log_file_path.parent.mkdir(parents=True, exist_ok=True)
     
     # Setup handlers
-    file_handler = logging.FileHandler(log_file_path)
-    file_handler.setLevel(log_config["file_level"])
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(log_config["console_level"])
-    
-    # Setup formatter
-    formatter = logging.Formatter(log_config["format"])
-    file_handler.setFormatter(formatter)
-    console_handler.setFormatter(formatter)
+    # Loggers only enqueue records; a listener thread does the formatting and file/console
+    # I/O, so a slow SD card write never stalls a sensor thread
+    queue_handler = queue_handlers.get(str(log_file_path))
+    if queue_handler is None:
+        formatter = logging.Formatter(log_config["format"])
+        
+        # Ensure log directory exists
+        log_file_path.parent.mkdir(parents=True, exist_ok=True)
+        # Rotate daily and keep logRetentionDays old files, so retention costs nothing at write time
+        file_handler = TimedRotatingFileHandler(
+            log_file_path,
+            when='midnight',
+            backupCount=config["logRetentionDays"],
+            encoding='utf-8',
+            delay=True
+        )
+        file_handler.setLevel(log_config["file_level"])
+        file_handler.setFormatter(formatter)
+        console_handler = logging.StreamHandler()
+        console_handler.setLevel(log_config["console_level"])
+        console_handler.setFormatter(formatter)
+        
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+        listener.start()
+        # Stopping the listener drains the queue, so records logged just before exit are kept
+        atexit.register(listener.stop)
+        
+        queue_handler = LocalQueueHandler(log_queue)
+        queue_handlers[str(log_file_path)] = queue_handler
     
     # Configure logger
     logger.setLevel(min(log_config["console_level"], log_config["file_level"]))
-    logger.handlers = []
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    logger.addHandler(queue_handler)
     
     return logger
 
-def clear_old_logs():
-    if LOG_FILE_PATH.exists():
-        cutoff_time = datetime.now() - timedelta(days=config["logRetentionDays"])
-        with open(LOG_FILE_PATH, 'r') as f:
-            lines = f.readlines()
-        with open(LOG_FILE_PATH, 'w') as f:
-            for line in lines:
-                log_time = datetime.strptime(line.split(' - ')[0], '%Y-%m-%d %H:%M:%S,%f')
-                if log_time > cutoff_time:
-                    f.write(line)
+def write_active_buffer_file(active):
+    """Atomically replace the active buffer pointer so the other process never reads it half-written"""
+    # Each process stages under its own name so the two never write or rename the same tmp file
+    tmp_file = ACTIVE_BUFFER_FILE.with_suffix(f'.{os.getpid()}.tmp')
+    with open(tmp_file, 'w') as f:
+        f.write(active)
+    os.replace(tmp_file, ACTIVE_BUFFER_FILE)
+
+def active_buffer_stat_key(stat):
+    """Identify one version of the pointer file"""
+    # 'A' and 'B' are both one byte and a switch can land within one mtime tick,
+    # but os.replace always installs a new inode
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
 
 def get_active_buffer():
-    if not ACTIVE_BUFFER_FILE.exists():
-        with open(ACTIVE_BUFFER_FILE, 'w') as f:
-            f.write('A')
-        return BUFFER_A
-    with open(ACTIVE_BUFFER_FILE, 'r') as f:
-        active = f.read().strip()
-    return BUFFER_A if active == 'A' else BUFFER_B
+    """Return the buffer file currently being written to.
+    
+    The reader and uploader run as separate processes and share the choice through
+    ACTIVE_BUFFER_FILE, so the parsed value is cached against the file's stat and
+    only re-read when the other process has switched buffers.
+    """
+    global active_buffer_cache
+    
+    with active_buffer_lock:
+        try:
+            stat = ACTIVE_BUFFER_FILE.stat()
+        except FileNotFoundError:
+            write_active_buffer_file('A')
+            stat = ACTIVE_BUFFER_FILE.stat()
+        
+        stat_key = active_buffer_stat_key(stat)
+        if active_buffer_cache is not None and active_buffer_cache[0] == stat_key:
+            return active_buffer_cache[1]
+        
+        with open(ACTIVE_BUFFER_FILE, 'r') as f:
+            active = f.read().strip()
+        active_buffer = BUFFER_A if active == 'A' else BUFFER_B
+        active_buffer_cache = (stat_key, active_buffer)
+        return active_buffer
 
 def switch_buffer():
-    with open(ACTIVE_BUFFER_FILE, 'r') as f:
-        current = f.read().strip()
-    with open(ACTIVE_BUFFER_FILE, 'w') as f:
-        f.write('B' if current == 'A' else 'A')
-    return BUFFER_B if current == 'A' else BUFFER_A
+    global active_buffer_cache
+    
+    with active_buffer_lock:
+        with open(ACTIVE_BUFFER_FILE, 'r') as f:
+            current = f.read().strip()
+        write_active_buffer_file('B' if current == 'A' else 'A')
+        
+        new_buffer = BUFFER_B if current == 'A' else BUFFER_A
+        stat = ACTIVE_BUFFER_FILE.stat()
+        active_buffer_cache = (active_buffer_stat_key(stat), new_buffer)
+        return new_buffer
 
 # Define what can be imported from this module
 __all__ = [
@@ -1,286 +1,524 @@
+import heapq
+import functools
 import random
+import struct
 import time
 import uuid
 import logging  # Add this import
+import os
+import queue
+import sys
 from datetime import datetime, timezone
 import serial
 import serial.tools.list_ports
+import threading
 from threading import Thread, Event, Lock
-import json
-from common import setup_logging, get_config, get_active_buffer, write_lock, get_tracked_guids, save_tracked_guids
+import orjson
+from common import setup_logging, get_config, get_active_buffer
 from pathlib import Path
 
 logger = setup_logging("telemetry_reader", log_file_path=Path("log/reader.log"))
 config = get_config()
 
-# Track telemetry GUIDs to ensure uniqueness
-telemetry_guid_lock = Lock()
-tracking_data = get_tracked_guids()
-telemetry_guids = set(tracking_data["reading_guids"])
-MAX_GUID_CACHE_SIZE = 10000  # Prevent memory growth
+# Logging levels are fixed at startup, so decide once whether to build debug messages
+DEBUG_ENABLED = logger.isEnabledFor(logging.DEBUG)
 
-logger.info(f"Loaded {len(telemetry_guids)} previously tracked reading GUIDs")
+# Readings are held in memory and appended to the active buffer in batches
+# to avoid a small disk write per reading (SD card wear on the Pi)
+FLUSH_THRESHOLD = config.get("flushThreshold", 10)
+FLUSH_INTERVAL_SECONDS = config.get("flushIntervalSec", 5)
+# Sensor threads hand encoded readings to the single writer thread through this queue;
+# pending_readings is owned by the writer, so the disk path needs no lock
+telemetry_queue = queue.SimpleQueue()
+pending_readings = []
 
-def is_port_available(port_number):
-    available_ports = [p.device for p in serial.tools.list_ports.comports()]
-    return port_number in available_ports
+# comports() walks every serial device, so one snapshot is shared by all threads for a few seconds
+PORT_CACHE_SECONDS = 5
+available_ports = set()
+available_ports_time = float('-inf')
+available_ports_lock = Lock()
 
-def generate_unique_reading_guid():
-    """Generate a unique reading GUID that hasn't been used before"""
-    with telemetry_guid_lock:
-        reading_guid = str(uuid.uuid4())
-        
-        # Extremely unlikely, but check if this GUID has been used before
-        while reading_guid in telemetry_guids:
-            reading_guid = str(uuid.uuid4())
-        
-        # Add to the tracking set
-        telemetry_guids.add(reading_guid)
-        
-        # Keep set size in check
-        if len(telemetry_guids) > MAX_GUID_CACHE_SIZE:
-            # Convert to list, trim, convert back to set to remove oldest entries
-            guid_list = list(telemetry_guids)
-            telemetry_guids.clear()
-            telemetry_guids.update(guid_list[-MAX_GUID_CACHE_SIZE:])
-        
-        # Update the persistent tracking file
-        global tracking_data
-        tracking_data["reading_guids"] = list(telemetry_guids)
-        save_tracked_guids(tracking_data)
-        
-        return reading_guid
+# Each ser.read() gives up after SERIAL_READ_TIMEOUT; read_exactly keeps reading until its
+# deadline, which is a fraction of the read interval capped at MAX_RESPONSE_WAIT_SECONDS
+SERIAL_READ_TIMEOUT = 0.2
+MAX_RESPONSE_WAIT_SECONDS = 3
 
-def write_telemetry_to_disk(data):
+# Serial handles are opened once and kept open across read cycles
+serial_handles = {}
+serial_handles_lock = Lock()
+
+def set_low_latency(ser, port_number):
+    """Drop the USB-serial latency timer to 1 ms so short Modbus replies aren't held for 16 ms"""
+    if not sys.platform.startswith("linux"):
+        return
+    
+    device_name = os.path.basename(os.path.realpath(port_number))
+    latency_file = Path("/sys/bus/usb-serial/devices") / device_name / "latency_timer"
+    
+    if latency_file.exists():
+        try:
+            previous = latency_file.read_text().strip()
+            latency_file.write_text("1")
+            logger.info(f"[SERIAL] Latency timer for {port_number} changed from {previous} ms to 1 ms")
+            return
+        except OSError as e:
+            logger.warning(f"[SERIAL] Could not set latency timer for {port_number}: {e}")
+    
+    # Fall back to the ASYNC_LOW_LATENCY flag (what setserial low_latency sets)
     try:
-        active_buffer = get_active_buffer()
-        with write_lock:
-            telemetry_data = []
-            if active_buffer.exists():
-                try:
-                    with open(active_buffer, 'r') as f:
-                        telemetry_data = json.load(f)
-                except (json.JSONDecodeError, FileNotFoundError):
-                    telemetry_data = []
-            
-            # Ensure data has a readingGUID if not already present
-            if "readingGUID" not in data:
-                data["readingGUID"] = generate_unique_reading_guid()
-            
-            telemetry_data.append(data)
+        ser.set_low_latency_mode(True)
+        logger.info(f"[SERIAL] Enabled low latency mode on {port_number}")
+    except Exception as e:
+        logger.warning(f"[SERIAL] Could not enable low latency mode on {port_number}: {e}")
+
+def get_serial_port(port_config):
+    """Return the open serial handle for a port, opening it on first use"""
+    port_number = port_config["gatewayPortId"]
+    
+    with serial_handles_lock:
+        ser = serial_handles.get(port_number)
+        if ser is None or not ser.is_open:
+            baud_rate = port_config.get("baudRate", 9600)
+            data_bits = port_config.get("dataBits", 8)
+            parity = port_config.get("parity", "None")
+            stop_bits = port_config.get("stopBits", 1)
             
-            # Ensure buffer directory exists
-            active_buffer.parent.mkdir(parents=True, exist_ok=True)
+            logger.info(f"[SERIAL] Opening serial port {port_number} - Baud: {baud_rate}, DataBits: {data_bits}, Parity: {parity}, StopBits: {stop_bits}")
             
-            with open(active_buffer, 'w') as f:
-                json.dump(telemetry_data, f, indent=2)
-            logger.info(f"Telemetry data written to buffer. Total records: {len(telemetry_data)}")
+            ser = serial.Serial(
+                port=port_number,
+                baudrate=baud_rate,
+                bytesize=serial.EIGHTBITS if data_bits == 8 else serial.SEVENBITS,
+                parity=serial.PARITY_NONE if parity == "None" else serial.PARITY_EVEN,
+                stopbits=serial.STOPBITS_ONE if stop_bits == 1 else serial.STOPBITS_TWO,
+                timeout=SERIAL_READ_TIMEOUT,
+                write_timeout=1
+            )
+            set_low_latency(ser, port_number)
+            serial_handles[port_number] = ser
+    
+    return ser
+
+def close_serial_port(port_number):
+    """Close and forget the shared handle for a port"""
+    with serial_handles_lock:
+        ser = serial_handles.pop(port_number, None)
+    
+    if ser is None:
+        return
+    
+    try:
+        ser.close()
+        logger.info(f"[SERIAL] Closed serial port {port_number}")
+    except Exception as e:
+        logger.error(f"[SERIAL] Error closing port {port_number}: {e}")
+
+def get_available_ports():
+    """Return the devices reported by comports(), refreshed at most every PORT_CACHE_SECONDS"""
+    global available_ports, available_ports_time
+    
+    with available_ports_lock:
+        if time.monotonic() - available_ports_time > PORT_CACHE_SECONDS:
+            available_ports = {p.device for p in serial.tools.list_ports.comports()}
+            available_ports_time = time.monotonic()
+        return available_ports
+
+def invalidate_available_ports():
+    """Force the next availability check to enumerate the ports again"""
+    global available_ports_time
+    
+    with available_ports_lock:
+        available_ports_time = float('-inf')
+
+def is_port_available(port_number):
+    # Serial ports are device nodes on POSIX, so a stat is enough; COM ports need enumerating
+    if os.name == "posix":
+        return os.path.exists(port_number)
+    return port_number in get_available_ports()
+
+def read_exactly(ser, length, deadline):
+    """Keep reading until length bytes have arrived or the monotonic deadline passes"""
+    buffer = bytearray()
+    while len(buffer) < length and time.monotonic() < deadline:
+        chunk = ser.read(length - len(buffer))
+        if chunk:
+            buffer.extend(chunk)
+    return bytes(buffer)
+
+# Readings carry ISO-8601 strings by default; "epochMs" sends an integer that is
+# cheaper to produce and roughly a third of the size on the wire. The datetime is handed
+# to orjson as-is; it writes the same ISO-8601 text as isoformat() without the Python call
+if config.get("timestampFormat", "iso8601") == "epochMs":
+    def reading_timestamp():
+        return time.time_ns() // 1_000_000
+else:
+    def reading_timestamp():
+        return datetime.now(timezone.utc)
+
+def generate_reading_guid():
+    """Generate a reading GUID.
+    
+    UUID4 collisions are negligible, so no record of issued GUIDs is kept to check against.
+    """
+    return str(uuid.uuid4())
+
+def append_to_file(path, data):
+    """Append bytes with raw os.write calls, skipping the buffered file object layer"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, 'O_BINARY', 0), 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+    finally:
+        os.close(fd)
+
+def flush_pending_readings():
+    """Append every queued reading to the active buffer.
+    
+    Only the writer thread calls this, or main once the writer has stopped. A failed
+    append leaves the batch in pending_readings so the next flush retries it in order.
+    """
+    while True:
+        try:
+            reading = telemetry_queue.get_nowait()
+        except queue.Empty:
+            break
+        if reading is not None:
+            pending_readings.append(reading)
+    
+    if not pending_readings:
+        return
+    
+    active_buffer = get_active_buffer()
+    
+    # Ensure buffer directory exists
+    active_buffer.parent.mkdir(parents=True, exist_ok=True)
+    
+    # Buffer is newline-delimited JSON, so a flush is a single append
+    # rather than a read/parse/rewrite of the whole file
+    append_to_file(active_buffer, b''.join(pending_readings))
+    logger.info("Flushed %d readings to buffer %s", len(pending_readings), active_buffer.name)
+    pending_readings.clear()
+
+def write_telemetry_to_disk(data):
+    try:
+        # Ensure data has a readingGUID if not already present
+        if "readingGUID" not in data:
+            data["readingGUID"] = generate_reading_guid()
+        
+        telemetry_queue.put(orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE))
     except Exception as e:
         logger.error(f"Error writing telemetry to disk: {e}")
 
-def calculate_crc(data):
-    crc = 0xFFFF
-    for pos in data:
-        crc ^= pos
+def write_telemetry_batches(shutdown_event):
+    """Single writer: collect readings from the sensor threads and append them in batches,
+    flushing every FLUSH_THRESHOLD readings or FLUSH_INTERVAL_SECONDS, whichever comes first"""
+    next_flush_time = time.monotonic() + FLUSH_INTERVAL_SECONDS
+    
+    while not shutdown_event.is_set():
+        try:
+            reading = telemetry_queue.get(timeout=max(0, next_flush_time - time.monotonic()))
+            # None is only a wake-up so shutdown doesn't wait out the interval
+            if reading is not None:
+                pending_readings.append(reading)
+        except queue.Empty:
+            pass
+        
+        if len(pending_readings) >= FLUSH_THRESHOLD or time.monotonic() >= next_flush_time:
+            next_flush_time = time.monotonic() + FLUSH_INTERVAL_SECONDS
+            try:
+                flush_pending_readings()
+            except Exception as e:
+                logger.error(f"Error flushing telemetry to disk: {e}")
+
+def build_crc16_table():
+    """Build the 256-entry lookup table for Modbus CRC16 (reflected polynomial 0xA001)"""
+    table = []
+    for byte in range(256):
+        crc = byte
         for _ in range(8):
-            if (crc & 0x0001) != 0:
-                crc >>= 1
-                crc ^= 0xA001
+            if crc & 0x0001:
+                crc = (crc >> 1) ^ 0xA001
             else:
                 crc >>= 1
+        table.append(crc)
+    return tuple(table)
+
+# One table lookup per byte instead of eight shift/xor steps
+CRC16_TABLE = build_crc16_table()
+
+def calculate_crc(data):
+    crc = 0xFFFF
+    for pos in data:
+        crc = (crc >> 8) ^ CRC16_TABLE[(crc ^ pos) & 0xFF]
     return crc.to_bytes(2, byteorder='little')
 
-def read_telemetry_from_port(port_config, shutdown_event):
+# Request frame: device address, function code, start register, register count
+MODBUS_REQUEST = struct.Struct('>BBHH')
+
+@functools.lru_cache(maxsize=None)
+def build_modbus_command(device_address, function_code, start_address, num_registers):
+    """Build the CRC'd request frame; a sensor's frame never changes, so each is built once"""
+    command_bytes = MODBUS_REQUEST.pack(device_address, function_code, start_address, num_registers)
+    return command_bytes + calculate_crc(command_bytes)
+
+# Big-endian decoders for the common register counts, so the value is read in place
+# without slicing the response
+REGISTER_STRUCTS = {1: struct.Struct('>H'), 2: struct.Struct('>I'), 4: struct.Struct('>Q')}
+
+def build_sensor_request(port_config):
+    """Work out a sensor's request frame, response length, data slice and scale once, before polling starts"""
+    # Modbus read command parameters - now consistent across all sensor types
+    device_address = port_config.get("deviceAddress", 1)
+    function_code = port_config.get("functionCode", 3)
+    start_address = port_config.get("startAddress", 0)
+    num_registers = port_config.get("numRegisters", 1)
+    
+    if DEBUG_ENABLED:
+        logger.debug(f"[MODBUS] Parameters for sensor {port_config['sensorId']} - Device: 0x{device_address:02X}, Function: 0x{function_code:02X}, Address: 0x{start_address:04X}, Registers: {num_registers}")
+    
+    full_command = build_modbus_command(device_address, function_code, start_address, num_registers)
+    # 1 byte address + 1 byte function code + 1 byte data length + data + 2 bytes CRC
+    expected_response_length = 5 + 2 * num_registers
+    data_slice = slice(3, 3 + num_registers * 2)
+    # Other register counts fall back to int.from_bytes on the data slice
+    value_struct = REGISTER_STRUCTS.get(num_registers)
+    # Raw register value multiplier, 0.1 unless the sensor's config says otherwise
+    scale = port_config.get("scaleFactor", 0.1)
+    return full_command, expected_response_length, data_slice, value_struct, scale
+
+def read_sensor(port_config, sensor_request, cycle_count):
+    """Run one telemetry read cycle for a sensor and buffer the reading"""
     port_number = port_config["gatewayPortId"]
     sensor_id = port_config["sensorId"]
     sensor_type_id = port_config["sensorTypeId"]
     sensor_type_code = port_config["sensorTypeCode"]
     sensor_position_id = port_config["sensorPositionId"]
-    seconds_between_reads = port_config["secondsBetweenReads"]
-    is_active = port_config["active"]
     should_simulate = port_config["simulate"]
     min_sim_value = port_config["mininimumSimulationValue"]
     max_sim_value = port_config["maximumSimulationValue"]
-
-    logger.info(f"[INIT] Sensor thread initialized - Port: {port_number}, SensorID: {sensor_id}, Type: {sensor_type_code}, Position: {sensor_position_id}")
-    logger.info(f"[INIT] Configuration - Active: {is_active}, Simulate: {should_simulate}, Read Interval: {seconds_between_reads}s")
     
-    if not is_active:
-        logger.info(f"[SHUTDOWN] Sensor {sensor_type_code} on port {port_number} is not active. Thread terminating.")
-        return
-
-    cycle_count = 0
+    # Durations use the monotonic clock so an NTP step can't make them negative
+    cycle_start_time = time.monotonic()
     
-    while not shutdown_event.is_set():
-        cycle_start_time = time.time()
-        cycle_count += 1
-        
-        try:
-            logger.info(f"[CYCLE-{cycle_count}] Starting telemetry read cycle for {sensor_type_code} on port {port_number}")
+    try:
+        # Per-cycle messages use %-style arguments so nothing is formatted when INFO is filtered out
+        logger.info("[CYCLE-%d] Starting telemetry read cycle for %s on port %s", cycle_count, sensor_type_code, port_number)
+        if DEBUG_ENABLED:
             logger.debug(f"[CYCLE-{cycle_count}] Details - Simulation: {should_simulate}, SimRange: [{min_sim_value}-{max_sim_value}]")
 
-            value = None
-            if should_simulate:
-                logger.info(f"[SIM-{cycle_count}] Simulating reading for {sensor_type_code} on port {port_number}")
-                value = random.uniform(min_sim_value, max_sim_value)
-                logger.info(f"[SIM-{cycle_count}] Generated simulated value: {value}")
-            else:
-                logger.info(f"[LIVE-{cycle_count}] Attempting live reading from {sensor_type_code} on port {port_number}")
-                
-                if not is_port_available(port_number):
-                    logger.error(f"[LIVE-{cycle_count}] Port {port_number} is not available. Available ports: {[p.device for p in serial.tools.list_ports.comports()]}")
-                    time.sleep(seconds_between_reads)
-                    continue
-
-                try:
-                    logger.debug(f"[SERIAL-{cycle_count}] Opening serial port {port_number}")
-                    serial_start_time = time.time()
-                    
-                    # Log serial port configuration
-                    baud_rate = port_config.get("baudRate", 9600)
-                    data_bits = port_config.get("dataBits", 8)
-                    parity = port_config.get("parity", "None")
-                    stop_bits = port_config.get("stopBits", 1)
-                    
-                    logger.debug(f"[SERIAL-{cycle_count}] Configuration - Baud: {baud_rate}, DataBits: {data_bits}, Parity: {parity}, StopBits: {stop_bits}")
-                    
-                    ser = serial.Serial(
-                        port=port_number,
-                        baudrate=baud_rate,
-                        bytesize=serial.EIGHTBITS if data_bits == 8 else serial.SEVENBITS,
-                        parity=serial.PARITY_NONE if parity == "None" else serial.PARITY_EVEN,
-                        stopbits=serial.STOPBITS_ONE if stop_bits == 1 else serial.STOPBITS_TWO,
-                        timeout=1,
-                        write_timeout=1
-                    )
-                    logger.debug(f"[SERIAL-{cycle_count}] Serial port {port_number} opened successfully")
-                    
-                    try:
-                        # Modbus read command parameters - now consistent across all sensor types
-                        device_address = port_config.get("deviceAddress", 1)
-                        function_code = port_config.get("functionCode", 3)
-                        start_address = port_config.get("startAddress", 0)
-                        num_registers = port_config.get("numRegisters", 1)
-
-                        logger.debug(f"[MODBUS-{cycle_count}] Parameters - Device: 0x{device_address:02X}, Function: 0x{function_code:02X}, Address: 0x{start_address:04X}, Registers: {num_registers}")
-                        
-                        # Build and send Modbus command
-                        command = f'{device_address:02X}{function_code:02X}{start_address:04X}{num_registers:04X}'
-                        command_bytes = bytes.fromhex(command)
-                        crc = calculate_crc(command_bytes)
-                        full_command = command_bytes + crc
-                        
-                        logger.debug(f"[MODBUS-{cycle_count}] Sending command: {full_command.hex()}")
-                        ser.write(full_command)
-                        
-                        # Read response
-                        expected_response_length = 5 + 2 * num_registers
-                        logger.debug(f"[MODBUS-{cycle_count}] Waiting for response, expected length: {expected_response_length} bytes")
-                        
-                        response = ser.read(expected_response_length)
-                        
-                        if response:
-                            logger.debug(f"[MODBUS-{cycle_count}] Received raw response: {response.hex()}")
-                            
-                            # Process response - standardized for all sensor types
-                            # Get data bytes based on number of registers
-                            data_bytes = response[3:3 + num_registers * 2]
-                            
-                            # Convert data to a value - use a standardized scaling factor of 0.1
-                            # This can be adjusted based on your specific needs or added as a config parameter
-                            raw_value = int.from_bytes(data_bytes, byteorder='big')
-                            value = raw_value * 0.1
-                            
-                            logger.debug(f"[MODBUS-{cycle_count}] Parsed value: {value} (raw hex: {data_bytes.hex()})")
-                            
-                            serial_end_time = time.time()
-                            logger.debug(f"[SERIAL-{cycle_count}] Serial communication completed in {serial_end_time - serial_start_time:.3f} seconds")
-                        else:
-                            logger.error(f"[MODBUS-{cycle_count}] No response received from {port_number} for {sensor_type_code}")
-                            # Log device status if possible
-                            if ser.in_waiting:
-                                logger.debug(f"[MODBUS-{cycle_count}] Bytes waiting in buffer: {ser.in_waiting}")
-                                remaining_data = ser.read(ser.in_waiting)
-                                if remaining_data:
-                                    logger.debug(f"[MODBUS-{cycle_count}] Remaining data in buffer: {remaining_data.hex()}")
-                    finally:
-                        logger.debug(f"[SERIAL-{cycle_count}] Closing serial port {port_number}")
-                        ser.close()
-                except Exception as e:
-                    import traceback
-                    logger.error(f"[SERIAL-{cycle_count}] Error accessing port {port_number}: {e}")
-                    logger.error(f"[SERIAL-{cycle_count}] Exception traceback: {traceback.format_exc()}")
-
-            if value is not None:
-                # Generate a unique GUID for this reading - it will persist even if the data is sent multiple times
-                reading_guid = generate_unique_reading_guid()
-                
-                telemetry_data = {
-                    "readingGUID": reading_guid,
-                    "sensorId": sensor_id,
-                    "sensorTypeId": sensor_type_id,
-                    "sensorTypeCode": sensor_type_code,
-                    "sensorPositionId": sensor_position_id,
-                    "gatewayPortId": port_number,
-                    "value": value,
-                    "isSimulated": should_simulate,
-                    "timestamp": datetime.now(timezone.utc).isoformat()
-                }
-                logger.info(f"[DATA-{cycle_count}] Writing telemetry data to disk with readingGUID: {reading_guid}")
-                
-                storage_start_time = time.time()
-                write_telemetry_to_disk(telemetry_data)
-                storage_end_time = time.time()
-                
+        value = None
+        if should_simulate:
+            logger.info("[SIM-%d] Simulating reading for %s on port %s", cycle_count, sensor_type_code, port_number)
+            value = random.uniform(min_sim_value, max_sim_value)
+            logger.info("[SIM-%d] Generated simulated value: %s", cycle_count, value)
+        else:
+            logger.info("[LIVE-%d] Attempting live reading from %s on port %s", cycle_count, sensor_type_code, port_number)
+
+            # An open handle proves the port is present; only enumerate ports before (re)opening it
+            if port_number not in serial_handles and not is_port_available(port_number):
+                logger.error(f"[LIVE-{cycle_count}] Port {port_number} is not available. Available ports: {sorted(get_available_ports())}")
+                close_serial_port(port_number)
+                return
+
+            try:
+                serial_start_time = time.monotonic()
+                ser = get_serial_port(port_config)
+                full_command, expected_response_length, data_slice, value_struct, scale = sensor_request
+
+                # Discard any stale bytes left over from a previous transaction
+                ser.reset_input_buffer()
+
+                if DEBUG_ENABLED:
+                    logger.debug(f"[MODBUS-{cycle_count}] Sending command: {full_command.hex()}")
+                ser.write(full_command)
+
+                # Read response
+                if DEBUG_ENABLED:
+                    logger.debug(f"[MODBUS-{cycle_count}] Waiting for response, expected length: {expected_response_length} bytes")
+
+                response_deadline = time.monotonic() + min(0.8 * port_config["secondsBetweenReads"], MAX_RESPONSE_WAIT_SECONDS)
+                response = read_exactly(ser, expected_response_length, response_deadline)
+
+                if len(response) == expected_response_length:
+                    if DEBUG_ENABLED:
+                        logger.debug(f"[MODBUS-{cycle_count}] Received raw response: {response.hex()}")
+
+                    # Process response - standardized for all sensor types
+                    # Decode the data registers that follow the address, function and length bytes
+                    if value_struct is not None:
+                        raw_value = value_struct.unpack_from(response, 3)[0]
+                    else:
+                        raw_value = int.from_bytes(response[data_slice], byteorder='big')
+
+                    # Convert data to a value using the sensor's precomputed scaling factor
+                    value = raw_value * scale
+
+                    if DEBUG_ENABLED:
+                        logger.debug(f"[MODBUS-{cycle_count}] Parsed value: {value} (raw hex: {response[data_slice].hex()})")
+
+                    serial_end_time = time.monotonic()
+                    if DEBUG_ENABLED:
+                        logger.debug(f"[SERIAL-{cycle_count}] Serial communication completed in {serial_end_time - serial_start_time:.3f} seconds")
+                elif response:
+                    logger.error(f"[MODBUS-{cycle_count}] Incomplete response from {port_number} for {sensor_type_code}: expected {expected_response_length} bytes, got {len(response)} ({response.hex()})")
+                else:
+                    logger.error(f"[MODBUS-{cycle_count}] No response received from {port_number} for {sensor_type_code}")
+                    # Log device status if possible
+                    if ser.in_waiting:
+                        logger.debug(f"[MODBUS-{cycle_count}] Bytes waiting in buffer: {ser.in_waiting}")
+                        remaining_data = ser.read(ser.in_waiting)
+                        if remaining_data:
+                            logger.debug(f"[MODBUS-{cycle_count}] Remaining data in buffer: {remaining_data.hex()}")
+            except Exception as e:
+                # logger.exception attaches the traceback, formatted only if the record is emitted
+                logger.exception("[SERIAL-%d] Error accessing port %s: %s", cycle_count, port_number, e)
+                # Drop the handle so the next cycle re-opens the port against a fresh port list
+                close_serial_port(port_number)
+                invalidate_available_ports()
+
+        if value is not None:
+            # Generate a unique GUID for this reading - it will persist even if the data is sent multiple times
+            reading_guid = generate_reading_guid()
+
+            telemetry_data = {
+                "readingGUID": reading_guid,
+                "sensorId": sensor_id,
+                "sensorTypeId": sensor_type_id,
+                "sensorTypeCode": sensor_type_code,
+                "sensorPositionId": sensor_position_id,
+                "gatewayPortId": port_number,
+                "value": value,
+                "isSimulated": should_simulate,
+                "timestamp": reading_timestamp()
+            }
+            logger.info("[DATA-%d] Writing telemetry data to disk with readingGUID: %s", cycle_count, reading_guid)
+
+            storage_start_time = time.monotonic()
+            write_telemetry_to_disk(telemetry_data)
+            storage_end_time = time.monotonic()
+
+            if DEBUG_ENABLED:
                 logger.debug(f"[DATA-{cycle_count}] Data storage completed in {storage_end_time - storage_start_time:.3f} seconds")
-            else:
-                logger.warning(f"[DATA-{cycle_count}] No valid reading obtained for {sensor_type_code} on port {port_number}")
+        else:
+            logger.warning("[DATA-%d] No valid reading obtained for %s on port %s", cycle_count, sensor_type_code, port_number)
 
-        except Exception as e:
-            import traceback
-            logger.error(f"[ERROR-{cycle_count}] Error in read_telemetry_from_port for {sensor_type_code} on port {port_number}: {e}")
-            logger.error(f"[ERROR-{cycle_count}] Exception traceback: {traceback.format_exc()}")
-        
-        # Calculate and log cycle timing information
-        cycle_end_time = time.time()
-        cycle_duration = cycle_end_time - cycle_start_time
-        logger.info(f"[TIMING-{cycle_count}] Cycle completed in {cycle_duration:.3f} seconds")
+    except Exception as e:
+        logger.exception("[ERROR-%d] Error in read_sensor for %s on port %s: %s", cycle_count, sensor_type_code, port_number, e)
+
+    # Calculate and log cycle timing information
+    cycle_end_time = time.monotonic()
+    cycle_duration = cycle_end_time - cycle_start_time
+    logger.info("[TIMING-%d] Cycle completed in %.3f seconds", cycle_count, cycle_duration)
+
+def poll_serial_port(port_number, port_configs, shutdown_event):
+    """Poll every active sensor on one serial port from a single thread.
+    
+    Modbus RTU allows one transaction on a bus at a time, so sensors sharing a port
+    are scheduled by their next due time rather than each getting its own thread.
+    """
+    for port_config in port_configs:
+        logger.info(f"[INIT] Sensor initialized - Port: {port_number}, SensorID: {port_config['sensorId']}, Type: {port_config['sensorTypeCode']}, Position: {port_config['sensorPositionId']}")
+        logger.info(f"[INIT] Configuration - Simulate: {port_config['simulate']}, Read Interval: {port_config['secondsBetweenReads']}s")
+    
+    sensor_requests = [build_sensor_request(port_config) for port_config in port_configs]
+    cycle_counts = [0] * len(port_configs)
+    schedule = [(time.monotonic(), index) for index in range(len(port_configs))]
+    heapq.heapify(schedule)
+    
+    while not shutdown_event.is_set():
+        due_time, index = schedule[0]
+        wait_time = due_time - time.monotonic()
+        if wait_time > 0:
+            if DEBUG_ENABLED:
+                logger.debug(f"[TIMING] Waiting {wait_time:.3f} seconds until next cycle on port {port_number}")
+            shutdown_event.wait(wait_time)
+            continue
         
-        # Calculate wait time (adjust if the cycle took longer than expected)
-        wait_time = max(0.1, seconds_between_reads - cycle_duration)
-        logger.debug(f"[TIMING-{cycle_count}] Waiting {wait_time:.3f} seconds until next cycle")
+        heapq.heappop(schedule)
+        port_config = port_configs[index]
+        cycle_counts[index] += 1
+        read_sensor(port_config, sensor_requests[index], cycle_counts[index])
         
-        shutdown_event.wait(wait_time)
+        # Schedule from the due time so the interval doesn't drift by the cycle duration
+        next_due_time = max(due_time + port_config["secondsBetweenReads"], time.monotonic() + 0.1)
+        heapq.heappush(schedule, (next_due_time, index))
     
-    logger.info(f"[SHUTDOWN] Telemetry reader thread for {sensor_type_code} on port {port_number} shutting down after {cycle_count} cycles")
+    close_serial_port(port_number)
+    logger.info(f"[SHUTDOWN] Telemetry reader thread for port {port_number} shutting down after {sum(cycle_counts)} cycles")
 
 def main():
     shutdown_event = Event()
     threads = []
     
+    def handle_thread_exception(args):
+        """Wake main as soon as any worker thread dies instead of waiting to notice"""
+        logger.critical(
+            f"Unhandled exception in thread {args.thread.name}: {args.exc_value}",
+            exc_info=(args.exc_type, args.exc_value, args.exc_traceback)
+        )
+        shutdown_event.set()
+    
+    threading.excepthook = handle_thread_exception
+    
     try:
         logger.info("Starting telemetry collection...")
         
+        writer_thread = Thread(
+            target=write_telemetry_batches,
+            args=(shutdown_event,),
+            name="TelemetryWriter"
+        )
+        writer_thread.daemon = True
+        writer_thread.start()
+        threads.append(writer_thread)
+        
+        # Group sensors by port so each serial bus is driven by a single thread
+        port_configs_by_port = {}
         for port_config in config["serialPorts"]:
             if port_config["active"]:
-                thread = Thread(
-                    target=read_telemetry_from_port,
-                    args=(port_config, shutdown_event),
-                    name=f"Port_{port_config['gatewayPortId']}"  # Changed from gatewayPortId to match config
-                )
-                thread.daemon = True
-                thread.start()
-                threads.append(thread)
-                logger.info(f"Started thread for {port_config['sensorTypeCode']} on {port_config['gatewayPortId']}")
+                port_configs_by_port.setdefault(port_config["gatewayPortId"], []).append(port_config)
+            else:
+                logger.info(f"Sensor {port_config['sensorTypeCode']} on port {port_config['gatewayPortId']} is not active")
         
-        while True:
-            time.sleep(1)
+        for port_number, port_configs in port_configs_by_port.items():
+            thread = Thread(
+                target=poll_serial_port,
+                args=(port_number, port_configs, shutdown_event),
+                name=f"Port_{port_number}"
+            )
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+            logger.info(f"Started thread for {', '.join(c['sensorTypeCode'] for c in port_configs)} on {port_number}")
+        
+        # Sleep until shutdown is requested or a worker thread dies
+        while not shutdown_event.wait(5):
+            pass
+        logger.error("A telemetry thread stopped unexpectedly. Shutting down telemetry collection...")
             
     except KeyboardInterrupt:
         logger.info("Shutting down telemetry collection...")
-        shutdown_event.set()
-        for thread in threads:
+    
+    shutdown_event.set()
+    telemetry_queue.put(None)
+    for thread in threads:
+        thread.join(timeout=5)
+    
+    for port_number in list(serial_handles):
+        close_serial_port(port_number)
+    
+    # Persist anything still held in memory before exiting. The writer may be mid-flush on a
+    # slow card, and flushing alongside it could write the same readings twice, so wait it out
+    for thread in threads:
+        while thread.name == "TelemetryWriter" and thread.is_alive():
+            logger.warning("Waiting for the telemetry writer to finish its flush...")
             thread.join(timeout=5)
+    try:
+        flush_pending_readings()
+    except Exception as e:
+        logger.error(f"Error flushing telemetry on shutdown: {e}")
     
     logger.info("Telemetry collection stopped")
 
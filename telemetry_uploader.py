@@ -1,19 +1,21 @@
 import time
 import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import os
 import sys
-import traceback
 from datetime import datetime, timezone
 from azure.iot.device import IoTHubDeviceClient, Message, exceptions
-import json
-from threading import Event, Thread, Lock
+import orjson
+from threading import Event, Thread
+import zstandard
 import gzip
-import shutil
 import socket
 from pathlib import Path
 from common import (
     setup_logging, get_config, get_active_buffer, switch_buffer,
-    write_lock, ARCHIVE_FILE_PATH, get_tracked_guids, save_tracked_guids
+    write_lock, ARCHIVE_FILE_PATH, BUFFER_A, get_tracked_guids, save_tracked_guids
 )
 
 logger = setup_logging("telemetry_uploader", log_file_path=Path("log/writer.log"))
@@ -22,48 +24,154 @@ config = get_config()
 # Global shutdown event that can be set from background threads
 global_shutdown_event = Event()
 
-# Client lock to prevent multiple connection issues
-client_lock = Lock()
+# Long-lived IoT Hub client, connected at startup and rebuilt only after a failed send.
+# Only the main loop replaces it, so it needs no lock
+iot_client = None
+
+# Successful connectivity probes are reused for this long
+INTERNET_CHECK_CACHE_SECONDS = 30
+internet_checked_at = None
 
-# Load tracking data from persistent storage
-tracking_data = get_tracked_guids()
-sent_payload_guids = set(tracking_data["payload_guids"])
 # Max size for the tracking set to prevent memory growth
 MAX_TRACKING_SIZE = 1000
+# Load tracking data from persistent storage; the deque keeps send order and evicts the oldest GUID
+sent_payload_guids = deque(get_tracked_guids()["payload_guids"], maxlen=MAX_TRACKING_SIZE)
+# Tracking file saves are deferred until this many sends or seconds have accumulated
+GUID_SAVE_EVERY = 20
+GUID_SAVE_INTERVAL_SECONDS = 60
+guid_tracking_pending = 0
+guid_tracking_saved_at = time.monotonic()
+
+# Send one block of value/timestamp columns per sensor instead of one object per reading
+COLUMNAR_TELEMETRY = config.get("columnarTelemetry", False)
+SENSOR_FIELDS = ("sensorId", "sensorTypeId", "sensorTypeCode", "sensorPositionId", "gatewayPortId", "isSimulated")
+
+# The gateway identity fields never change, so serialize them once and leave the object open
+ENVELOPE_PREFIX = orjson.dumps({
+    "gatewayId": config["gatewayId"],
+    "modelNumber": config["modelNumber"],
+    "serialNumber": config["serialNumber"],
+    "organisationId": config["organisationId"],
+    "siteId": config["siteId"]
+})[:-1]
+
+# Split large buffers so each message stays under the 256 KB IoT Hub limit and a failed
+# send only has to repeat its own chunk
+MAX_PAYLOAD_BYTES = 200 * 1024
+MAX_RECORDS_PER_PAYLOAD = 500
+
+# Gzip payloads before sending; the cloud side must honour the message's content encoding
+COMPRESS_TELEMETRY = config.get("compressTelemetry", False)
+
+# zstd level 3 compresses JSON faster and smaller than gzip; threads=-1 uses every core
+archive_compressor = zstandard.ZstdCompressor(level=3, threads=-1)
+# Archives are compressed on a worker thread so a large buffer doesn't delay the next send.
+# A sent buffer is renamed aside until its archive is on disk, so a crash never loses it
+archive_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="TelemetryArchiver")
+pending_archives = deque()
+MAX_PENDING_ARCHIVES = 3
+ARCHIVE_PENDING_SUFFIX = ".archiving"
+
+def stage_for_archive(buffer_file):
+    """Move a sent buffer out of the A/B rotation until the archive thread has written it"""
+    staged_file = buffer_file.with_name(f"{buffer_file.stem}_{time.time_ns()}{ARCHIVE_PENDING_SUFFIX}")
+    os.replace(buffer_file, staged_file)
+    return staged_file
+
+def queue_archive(telemetry_records, source_file=None):
+    """Hand sent records to the archive thread, archiving inline if it has fallen behind"""
+    while pending_archives and pending_archives[0].done():
+        pending_archives.popleft()
+    if len(pending_archives) >= MAX_PENDING_ARCHIVES:
+        logger.warning(f"Archive backlog full, archiving {len(telemetry_records)} sent records inline")
+        archive_telemetry_data(telemetry_records, source_file)
+        return
+    pending_archives.append(archive_executor.submit(archive_telemetry_data, telemetry_records, source_file))
+
+def recover_staged_archives():
+    """Queue sent buffers whose archive was not written before the last shutdown"""
+    for staged_file in sorted(BUFFER_A.parent.glob(f"*{ARCHIVE_PENDING_SUFFIX}")):
+        try:
+            queue_archive(read_telemetry_buffer(staged_file), staged_file)
+        except Exception as e:
+            logger.error(f"Error recovering staged archive {staged_file.name}: {e}")
 
 def sanitize_filename(timestamp):
     return timestamp.replace(':', '-').replace('+', '_plus_')
 
-def archive_telemetry_data(buffer_file):
+def archive_telemetry_data(telemetry_records, source_file=None):
+    """Compress the records already read for sending into the archive, then remove their staged file if given"""
     try:
         archive_dir = Path(ARCHIVE_FILE_PATH)
         archive_dir.mkdir(parents=True, exist_ok=True)
         
         timestamp = datetime.now(timezone.utc).isoformat()
         safe_timestamp = sanitize_filename(timestamp)
-        archive_file = archive_dir / f"telemetry_{safe_timestamp}.json.gz"
+        archive_file = archive_dir / f"telemetry_{safe_timestamp}.json.zst"
         
-        with gzip.open(archive_file, 'wb') as f_out:
-            with open(buffer_file, 'rb') as f_in:
-                shutil.copyfileobj(f_in, f_out)
-        buffer_file.unlink(missing_ok=True)
+        # The records are already in memory from the send, so don't read the buffer a second time.
+        # Write under a temporary name and fsync before the rename, so the staged buffer is only
+        # deleted once a complete archive is on disk
+        tmp_file = archive_file.with_name(archive_file.name + '.tmp')
+        with open(tmp_file, 'wb') as f_out:
+            f_out.write(archive_compressor.compress(b'\n'.join(telemetry_records) + b'\n'))
+            f_out.flush()
+            os.fsync(f_out.fileno())
+        os.replace(tmp_file, archive_file)
+        if source_file is not None:
+            source_file.unlink(missing_ok=True)
         logger.info(f"Telemetry data archived to {archive_file}")
     except Exception as e:
+        # Runs on the archive thread with nobody waiting on the result; a staged file is
+        # left in place and retried at the next startup
         logger.error(f"Error archiving telemetry data: {e}")
-        raise
+
+def read_telemetry_buffer(buffer_file):
+    """Read the raw JSON records from a newline-delimited buffer, skipping corrupt lines"""
+    telemetry_records = []
+    # One unbuffered read of the whole file, then split in memory, rather than line-by-line reads
+    with open(buffer_file, 'rb', buffering=0) as f:
+        data = f.read()
+    for line in data.split(b'\n'):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            orjson.loads(line)
+        except orjson.JSONDecodeError:
+            logger.warning(f"Skipping corrupt record in {buffer_file.name}: {line[:80]!r}")
+            continue
+        telemetry_records.append(line)
+    return telemetry_records
 
 def check_internet_connection():
     """Check if there is an active internet connection"""
+    global internet_checked_at
+    
+    # A recent successful probe is trusted; failures are always re-probed
+    if internet_checked_at is not None and time.monotonic() - internet_checked_at < INTERNET_CHECK_CACHE_SECONDS:
+        return True
+    
     try:
         # Try to connect to a reliable server (Cloudflare DNS)
-        socket.create_connection(("1.1.1.1", 53), timeout=5)
+        with socket.create_connection(("1.1.1.1", 53), timeout=1):
+            pass
+        internet_checked_at = time.monotonic()
         return True
     except (socket.timeout, socket.error):
+        internet_checked_at = None
         return False
 
-def handle_connection_state_change(connected):
+def invalidate_internet_check():
+    """Forget the last successful probe so the next check goes to the network"""
+    global internet_checked_at
+    internet_checked_at = None
+
+def handle_connection_state_change():
     """Handle connection state changes"""
-    if connected:
+    # The SDK passes no arguments; the new state is on the client itself
+    client = iot_client
+    if client is not None and client.connected:
         logger.info("Device connected to IoT Hub")
     else:
         # Just log this, don't take any action
@@ -106,37 +214,97 @@ def safe_client_shutdown(client):
     
     logger.info("Client resources released")
 
-def update_guid_tracking():
+def get_connected_client():
+    """Return the shared IoT Hub client, creating and connecting it if needed."""
+    global iot_client
+    
+    if iot_client is None:
+        iot_client = create_client()
+    if not iot_client.connected:
+        iot_client.connect()
+        logger.info("Connected to IoT Hub")
+    return iot_client
+
+def reset_client():
+    """Shut down and forget the shared IoT Hub client."""
+    global iot_client
+    
+    safe_client_shutdown(iot_client)
+    iot_client = None
+
+def update_guid_tracking(force=False):
     """Save the current tracking data to disk for persistence across restarts"""
-    global tracking_data, sent_payload_guids
+    global guid_tracking_pending, guid_tracking_saved_at
+    
+    # Coalesce saves so the SD card sees one rewrite per GUID_SAVE_EVERY sends or
+    # GUID_SAVE_INTERVAL_SECONDS, not one per send
+    guid_tracking_pending += 1
+    if not force and guid_tracking_pending < GUID_SAVE_EVERY and time.monotonic() - guid_tracking_saved_at < GUID_SAVE_INTERVAL_SECONDS:
+        return
     
-    tracking_data["payload_guids"] = list(sent_payload_guids)
-    save_tracked_guids(tracking_data)
+    save_tracked_guids({"payload_guids": list(sent_payload_guids)})
+    guid_tracking_pending = 0
+    guid_tracking_saved_at = time.monotonic()
     logger.debug(f"Updated GUID tracking file with {len(sent_payload_guids)} payload GUIDs")
 
-def prepare_telemetry_payload(telemetry_data):
-    """Prepare a payload with consistent GUID handling"""
+def flush_guid_tracking():
+    """Write out any payload GUIDs whose save was deferred"""
+    if guid_tracking_pending:
+        update_guid_tracking(force=True)
+
+def build_columnar_telemetry(telemetry_records):
+    """Group buffered readings per sensor so the static sensor fields are sent once per payload"""
+    sensors = {}
+    for record in telemetry_records:
+        reading = orjson.loads(record)
+        key = tuple(reading[field] for field in SENSOR_FIELDS)
+        sensor = sensors.get(key)
+        if sensor is None:
+            sensor = dict(zip(SENSOR_FIELDS, key))
+            sensor.update({"readingGUIDs": [], "values": [], "timestamps": []})
+            sensors[key] = sensor
+        sensor["readingGUIDs"].append(reading["readingGUID"])
+        sensor["values"].append(reading["value"])
+        sensor["timestamps"].append(reading["timestamp"])
+    return list(sensors.values())
+
+def prepare_telemetry_payload(telemetry_records):
+    """Prepare an encoded payload with consistent GUID handling"""
     # Generate a new payloadGUID that will be consistent for retries
+    # A uuid4 collision is astronomically unlikely, so it isn't checked against past sends
     payload_guid = str(uuid.uuid4())
     
-    # Check if this payload GUID has been used before (extremely unlikely but possible)
-    while payload_guid in sent_payload_guids:
-        payload_guid = str(uuid.uuid4())
+    if COLUMNAR_TELEMETRY:
+        telemetry = orjson.dumps(build_columnar_telemetry(telemetry_records))
+    else:
+        # Records are already JSON in the buffer, so splice them in rather than decoding and re-encoding
+        telemetry = b'[' + b','.join(telemetry_records) + b']'
     
-    # Create the payload with the consistent GUID
-    payload = {
-        "payloadGUID": payload_guid,
-        "gatewayId": config["gatewayId"],
-        "modelNumber": config["modelNumber"],
-        "serialNumber": config["serialNumber"],
-        "organisationId": config["organisationId"],
-        "siteId": config["siteId"],
-        "telemetry": telemetry_data,
-        "timestamp": datetime.now(timezone.utc).isoformat()
-    }
+    # Only the GUID, timestamp and telemetry change between payloads; orjson serializes
+    # the datetime as ISO-8601 itself
+    payload = (
+        ENVELOPE_PREFIX
+        + b',"payloadGUID":"' + payload_guid.encode() + b'"'
+        + b',"timestamp":' + orjson.dumps(datetime.now(timezone.utc))
+        + b',"telemetry":' + telemetry + b'}'
+    )
     
     return payload, payload_guid
 
+def chunk_telemetry_records(telemetry_records):
+    """Yield (start, end) bounds of consecutive records that fit in one message"""
+    start = 0
+    chunk_bytes = 0
+    for index, record in enumerate(telemetry_records):
+        record_bytes = len(record) + 1
+        if index > start and (chunk_bytes + record_bytes > MAX_PAYLOAD_BYTES or index - start >= MAX_RECORDS_PER_PAYLOAD):
+            yield start, index
+            start = index
+            chunk_bytes = 0
+        chunk_bytes += record_bytes
+    if start < len(telemetry_records):
+        yield start, len(telemetry_records)
+
 def send_message_with_retry(telemetry_data, shutdown_event):
     """Send a single message with retry logic"""
     max_retries = 3
@@ -145,81 +313,87 @@ def send_message_with_retry(telemetry_data, shutdown_event):
     # Prepare the payload once to ensure consistent GUID across retries
     payload, payload_guid = prepare_telemetry_payload(telemetry_data)
     
+    # JSON compresses 5-10x; level 1 gets nearly all of that for a fraction of the CPU
+    if COMPRESS_TELEMETRY:
+        payload = gzip.compress(payload, compresslevel=1)
+    
+    # Build the message once as well - every retry sends the same bytes
+    telemetry_message = Message(
+        payload,
+        content_encoding="gzip" if COMPRESS_TELEMETRY else "utf-8",
+        content_type="application/json"
+    )
+    if COMPRESS_TELEMETRY:
+        # Lets the backend route pick out compressed messages without inspecting system properties
+        telemetry_message.custom_properties["compression"] = "gzip"
+    
     while retry_count < max_retries and not shutdown_event.is_set():
-        with client_lock:  # Ensure we don't have overlapping client operations
-            client = None
-            try:
-                # Create a fresh client for each attempt
-                client = create_client()
-                
-                # Connect to IoT Hub
-                client.connect()
-                logger.info("Connected to IoT Hub for message send")
-                
-                # Create and send the message - using the same payload for all retries
-                telemetry_message = Message(json.dumps(payload))
-                telemetry_message.content_type = "application/json"
-                telemetry_message.content_encoding = "utf-8"
-                
-                logger.info(f"Sending telemetry message with {len(telemetry_data)} readings, payloadGUID: {payload_guid}")
-                # Send the message and wait for the result
-                client.send_message(telemetry_message)
-                logger.info("Message sent successfully")
-                
-                # Clean shutdown
-                safe_client_shutdown(client)
-                
-                # Track this payload as successfully sent
-                sent_payload_guids.add(payload_guid)
-                
-                # Limit the size of the tracking set to prevent memory growth
-                if len(sent_payload_guids) > MAX_TRACKING_SIZE:
-                    # Remove the oldest entries (convert to list, slice, convert back to set)
-                    sent_payload_guids_list = list(sent_payload_guids)
-                    sent_payload_guids.clear()
-                    sent_payload_guids.update(sent_payload_guids_list[-MAX_TRACKING_SIZE:])
-                
-                # Update the persistent tracking file
-                update_guid_tracking()
-                
-                # Message sent successfully
-                return True
-                
-            except Exception as e:
-                retry_count += 1
-                logger.error(f"Error on send attempt {retry_count}: {str(e)}")
-                
-                # Clean up client resources
-                safe_client_shutdown(client)
-                
-                if retry_count < max_retries:
-                    # Wait with exponential backoff
-                    wait_time = 5 * retry_count
-                    logger.info(f"Retrying in {wait_time} seconds...")
-                    time.sleep(wait_time)
-                else:
-                    logger.error("Max retries reached. Failed to send message.")
+        try:
+            client = get_connected_client()
+            
+            logger.info(f"Sending telemetry message with {len(telemetry_data)} readings, payloadGUID: {payload_guid}")
+            # Send the message and wait for the result
+            client.send_message(telemetry_message)
+            logger.info("Message sent successfully")
+            
+            # Track this payload as successfully sent; the deque drops the oldest once full
+            sent_payload_guids.append(payload_guid)
+            
+            # Update the persistent tracking file
+            update_guid_tracking()
+            
+            # Message sent successfully
+            return True
+            
+        except Exception as e:
+            retry_count += 1
+            logger.error(f"Error on send attempt {retry_count}: {str(e)}")
+            
+            # Drop the client so the next attempt starts from a fresh connection
+            reset_client()
+            invalidate_internet_check()
+            
+            if retry_count < max_retries:
+                # Wait with exponential backoff
+                wait_time = 5 * retry_count
+                logger.info(f"Retrying in {wait_time} seconds...")
+                shutdown_event.wait(wait_time)
+            else:
+                logger.error("Max retries reached. Failed to send message.")
     
     return False
 
 def safe_send_telemetry(telemetry_data, shutdown_event):
-    """Send telemetry with proper error handling and buffer management"""
+    """Send telemetry in size-bounded chunks, returning how many leading records were sent"""
     if not telemetry_data:
         logger.info("No telemetry data to send")
-        return True
+        return 0
     
+    sent_count = 0
     try:
-        # Check internet connection first
-        if not check_internet_connection():
+        # A connected client is proof enough of connectivity; only probe the network when it's down
+        if not (iot_client is not None and iot_client.connected) and not check_internet_connection():
             logger.warning("No internet connection available. Will retry later.")
-            return False
+            return 0
         
-        # Send message with retry logic
-        return send_message_with_retry(telemetry_data, shutdown_event)
+        # The SDK has no batch send, so chunks go one message at a time; stop at the first
+        # failure so the records after it stay in order for the next attempt
+        for start, end in chunk_telemetry_records(telemetry_data):
+            if not send_message_with_retry(telemetry_data[start:end], shutdown_event):
+                break
+            sent_count = end
+        return sent_count
         
     except Exception as e:
         logger.error(f"Unexpected error in safe_send_telemetry: {e}")
-        return False
+        return sent_count
+
+def retain_unsent_records(buffer_file, telemetry_records):
+    """Rewrite the send buffer with only the records that still need sending"""
+    tmp_file = buffer_file.with_suffix('.tmp')
+    with open(tmp_file, 'wb') as f:
+        f.write(b'\n'.join(telemetry_records) + b'\n')
+    os.replace(tmp_file, buffer_file)
 
 def main():
     shutdown_event = global_shutdown_event
@@ -228,50 +402,67 @@ def main():
         logger.info("Starting telemetry uploader")
         logger.info(f"Loaded {len(sent_payload_guids)} previously sent payload GUIDs for tracking")
         
-        last_send_time = time.time()
+        if config["archiveTelemetry"]:
+            recover_staged_archives()
+        
+        # Connect up front so the TLS handshake isn't paid by the first send
+        try:
+            get_connected_client()
+        except Exception as e:
+            logger.warning(f"Could not connect to IoT Hub at startup, will retry on send: {e}")
+            reset_client()
+        
         seconds_between_sends = config["secondsBetweenSends"]
+        next_send_time = time.monotonic() + seconds_between_sends
         
-        while not shutdown_event.is_set():
-            current_time = time.time()
-            if current_time - last_send_time >= seconds_between_sends:
-                logger.info("Preparing to send telemetry data to IoT Hub")
-                
-                # Switch buffers atomically
+        # Sleep until the next send is due; setting shutdown_event wakes the loop immediately
+        while not shutdown_event.wait(max(0, next_send_time - time.monotonic())):
+            next_send_time = time.monotonic() + seconds_between_sends
+            
+            logger.info("Preparing to send telemetry data to IoT Hub")
+            
+            # Switch buffers atomically
+            try:
                 with write_lock:
                     send_buffer = get_active_buffer()
                     if send_buffer.exists():
-                        new_buffer = switch_buffer()
-                        # Initialize new buffer
-                        with open(new_buffer, 'w') as f:
-                            json.dump([], f)
-                
-                # Process the full buffer
-                if send_buffer.exists():
-                    try:
-                        with open(send_buffer, 'r') as f:
-                            telemetry_data = json.load(f)
-                        logger.info(f"Read {len(telemetry_data)} records from buffer")
+                        # The reader appends to the new buffer, creating it on first write
+                        switch_buffer()
+            except OSError as e:
+                # e.g. the reader holds the pointer file open on Windows; the buffer is still active, so don't send it
+                logger.error(f"Could not switch telemetry buffers, will retry next cycle: {e}")
+                continue
+            
+            # Process the full buffer
+            if send_buffer.exists():
+                try:
+                    telemetry_data = read_telemetry_buffer(send_buffer)
+                    logger.info(f"Read {len(telemetry_data)} records from buffer")
+                    
+                    # Send telemetry with our improved function
+                    if telemetry_data:
+                        sent_count = safe_send_telemetry(telemetry_data, shutdown_event)
                         
-                        # Send telemetry with our improved function
-                        if telemetry_data:
-                            success = safe_send_telemetry(telemetry_data, shutdown_event)
-                            
-                            # Handle the buffer based on success
-                            if success:
-                                if config["archiveTelemetry"]:
-                                    archive_telemetry_data(send_buffer)
-                                else:
-                                    send_buffer.unlink(missing_ok=True)
-                                    logger.info("Send buffer cleared")
+                        # Handle the buffer based on how much was sent
+                        if sent_count == len(telemetry_data):
+                            if config["archiveTelemetry"]:
+                                queue_archive(telemetry_data, stage_for_archive(send_buffer))
+                                logger.info("Send buffer handed to the archiver")
                             else:
-                                logger.warning("Failed to send telemetry. Buffer will be retained for next attempt.")
-                    
-                    except Exception as e:
-                        logger.error(f"Error processing send buffer: {e}")
+                                send_buffer.unlink(missing_ok=True)
+                                logger.info("Send buffer cleared")
+                        elif sent_count:
+                            # Archive the sent part before trimming it from the buffer, then keep only
+                            # the unsent chunks so the next attempt doesn't resend the rest
+                            if config["archiveTelemetry"]:
+                                archive_telemetry_data(telemetry_data[:sent_count])
+                            retain_unsent_records(send_buffer, telemetry_data[sent_count:])
+                            logger.warning(f"Sent {sent_count} of {len(telemetry_data)} records. Remainder will be retained for next attempt.")
+                        else:
+                            logger.warning("Failed to send telemetry. Buffer will be retained for next attempt.")
                 
-                last_send_time = current_time
-            
-            time.sleep(1)
+                except Exception as e:
+                    logger.error(f"Error processing send buffer: {e}")
             
     except KeyboardInterrupt:
         logger.info("Shutting down uploader...")
@@ -279,6 +470,12 @@ def main():
     except Exception as e:
         logger.critical(f"Unexpected error in main loop: {e}", exc_info=True)
         shutdown_event.set()
+    
+    reset_client()
+    
+    flush_guid_tracking()
+    # Let archives already handed to the worker finish writing
+    archive_executor.shutdown(wait=True)
 
 if __name__ == "__main__":
     main()